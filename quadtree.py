@@ -0,0 +1,273 @@
+from math import sqrt
+from typing import Any
+
+import numpy as np
+from numba import njit, prange
+from numpy.typing import NDArray
+
+MAXIMUM_DEPTH = 64
+
+# Columns of the cells array of a tree
+CENTRE_X = 0
+CENTRE_Y = 1
+WIDTH = 2
+MASS = 3
+COM_X = 4
+COM_Y = 5
+
+# Columns of the links array of a tree; -1 means none
+FIRST_CHILD = 0
+FIRST_BODY = 1
+
+
+@njit(cache=True, nogil=True)
+def grow(cells: NDArray[np.float64], links: NDArray[np.int64]
+         ) -> tuple[NDArray[np.float64], NDArray[np.int64]]:
+    """
+    Double the number of cells a tree has room for.
+
+    :param cells: The float columns of every cell
+    :param links: The index columns of every cell
+    :return: The larger cells and links, with the old rows copied over
+    """
+    new_cells = np.empty((2 * cells.shape[0], cells.shape[1]))
+    new_links = np.empty((2 * links.shape[0], links.shape[1]), np.int64)
+    new_cells[:cells.shape[0]] = cells
+    new_links[:links.shape[0]] = links
+    return new_cells, new_links
+
+
+@njit(cache=True, nogil=True)
+def quadrant(cells: NDArray[np.float64], cell: int,
+             x: float, y: float) -> int:
+    """
+    Find which of a cell's four children contains a position.
+
+    :param cells: The float columns of every cell
+    :param cell: Index of the cell
+    :param x, y: Position in meters
+    """
+    return int(x >= cells[cell, CENTRE_X]) \
+        + 2 * int(y >= cells[cell, CENTRE_Y])
+
+
+@njit(cache=True, nogil=True)
+def build_tree(mass: NDArray[np.float64],
+               x: NDArray[np.float64], y: NDArray[np.float64]
+               ) -> tuple[NDArray[np.float64], NDArray[np.int64],
+                          NDArray[np.int64]]:
+    """
+    Build a quadtree over all bodies in flat arrays, splitting cells until
+    each holds one body, then fill in the total mass and centre of mass of
+    every cell. Bodies too close to separate share a cell. Children are
+    always stored after their parent, four in a row. Compiled to native
+    code with Numba.
+
+    :param mass: Masses in kilograms
+    :param x, y: Positions in meters
+    :return: The cells, the links, and the next body in the same cell for
+             each body
+    """
+    n = mass.shape[0]
+    cells = np.zeros((4 * n + 4, 6))
+    links = np.full((4 * n + 4, 2), -1, np.int64)
+    next_body = np.full(n, -1, np.int64)
+
+    cells[0, CENTRE_X] = (x.min() + x.max()) / 2
+    cells[0, CENTRE_Y] = (y.min() + y.max()) / 2
+    cells[0, WIDTH] = max(x.max() - x.min(), y.max() - y.min(), 1.0) \
+        * (1 + 1e-9)
+    count = 1
+
+    for body in range(n):
+        cell = 0
+        depth = 0
+        while True:
+            if links[cell, FIRST_CHILD] >= 0:
+                cell = links[cell, FIRST_CHILD] \
+                    + quadrant(cells, cell, x[body], y[body])
+                depth += 1
+            elif links[cell, FIRST_BODY] < 0 or depth >= MAXIMUM_DEPTH:
+                next_body[body] = links[cell, FIRST_BODY]
+                links[cell, FIRST_BODY] = body
+                break
+            else:
+                if count + 4 > cells.shape[0]:
+                    (cells, links) = grow(cells, links)
+
+                quarter = cells[cell, WIDTH] / 4
+                for child in range(4):
+                    cells[count + child, CENTRE_X] = cells[cell, CENTRE_X] \
+                        + (2 * (child % 2) - 1) * quarter
+                    cells[count + child, CENTRE_Y] = cells[cell, CENTRE_Y] \
+                        + (2 * (child // 2) - 1) * quarter
+                    cells[count + child, WIDTH] = 2 * quarter
+                    links[count + child, FIRST_CHILD] = -1
+                    links[count + child, FIRST_BODY] = -1
+                links[cell, FIRST_CHILD] = count
+                count += 4
+
+                other = links[cell, FIRST_BODY]
+                links[cell, FIRST_BODY] = -1
+                child = links[cell, FIRST_CHILD] \
+                    + quadrant(cells, cell, x[other], y[other])
+                links[child, FIRST_BODY] = other
+
+    for cell in range(count - 1, -1, -1):
+        total = com_x = com_y = 0.0
+        if links[cell, FIRST_CHILD] >= 0:
+            for child in range(links[cell, FIRST_CHILD],
+                               links[cell, FIRST_CHILD] + 4):
+                total += cells[child, MASS]
+                com_x += cells[child, MASS] * cells[child, COM_X]
+                com_y += cells[child, MASS] * cells[child, COM_Y]
+        else:
+            body = links[cell, FIRST_BODY]
+            while body >= 0:
+                total += mass[body]
+                com_x += mass[body] * x[body]
+                com_y += mass[body] * y[body]
+                body = next_body[body]
+
+        cells[cell, MASS] = total
+        if total > 0.0:
+            cells[cell, COM_X] = com_x / total
+            cells[cell, COM_Y] = com_y / total
+
+    return cells, links, next_body
+
+
+@njit(cache=True, nogil=True)
+def field_at(body: int, cells: NDArray[np.float64],
+             links: NDArray[np.int64], next_body: NDArray[np.int64],
+             mass: NDArray[np.float64],
+             x: NDArray[np.float64], y: NDArray[np.float64],
+             theta: float) -> tuple[float, float]:
+    """
+    Sum the gravitational field on one body, walking the tree from the root
+    and treating any cell that looks smaller than theta from the body as a
+    single mass at its centre of mass. A cell containing the body is always
+    opened, so the body never pulls on itself. Compiled to native code with
+    Numba.
+
+    :param body: Index of the body feeling the field
+    :param cells, links, next_body: The tree from build_tree()
+    :param mass: Masses of all bodies in kilograms
+    :param x, y: Positions of all bodies in meters
+    :param theta: The opening angle, as cell width over distance
+    :return: The field divided by the gravitational constant
+    """
+    body_x = x[body]
+    body_y = y[body]
+    x_field = y_field = 0.0
+
+    stack = np.empty(3 * MAXIMUM_DEPTH + 4, np.int64)
+    stack[0] = 0
+    depth = 1
+
+    while depth > 0:
+        depth -= 1
+        cell = stack[depth]
+        if cells[cell, MASS] == 0.0:
+            continue
+
+        if links[cell, FIRST_CHILD] < 0:
+            other = links[cell, FIRST_BODY]
+            while other >= 0:
+                if other != body:
+                    x_distance = x[other] - body_x
+                    y_distance = y[other] - body_y
+                    distance_squared = x_distance * x_distance \
+                        + y_distance * y_distance
+                    inverse_distance = 1.0 / sqrt(distance_squared)
+                    mass_over_distance_cubed = mass[other] \
+                        * inverse_distance * inverse_distance \
+                        * inverse_distance
+                    x_field += mass_over_distance_cubed * x_distance
+                    y_field += mass_over_distance_cubed * y_distance
+                other = next_body[other]
+            continue
+
+        half_width = cells[cell, WIDTH] / 2
+        contains_body = \
+            abs(body_x - cells[cell, CENTRE_X]) <= half_width \
+            and abs(body_y - cells[cell, CENTRE_Y]) <= half_width
+        x_distance = cells[cell, COM_X] - body_x
+        y_distance = cells[cell, COM_Y] - body_y
+        distance_squared = x_distance * x_distance + y_distance * y_distance
+
+        if (not contains_body and cells[cell, WIDTH] * cells[cell, WIDTH]
+                < theta * theta * distance_squared):
+            inverse_distance = 1.0 / sqrt(distance_squared)
+            mass_over_distance_cubed = cells[cell, MASS] \
+                * inverse_distance * inverse_distance * inverse_distance
+            x_field += mass_over_distance_cubed * x_distance
+            y_field += mass_over_distance_cubed * y_distance
+        else:
+            for child in range(links[cell, FIRST_CHILD],
+                               links[cell, FIRST_CHILD] + 4):
+                stack[depth] = child
+                depth += 1
+
+    return x_field, y_field
+
+
+@njit(cache=True, nogil=True, parallel=True)
+def fill_fields(cells: NDArray[np.float64], links: NDArray[np.int64],
+                next_body: NDArray[np.int64], mass: NDArray[np.float64],
+                x: NDArray[np.float64], y: NDArray[np.float64],
+                theta: float, x_field: NDArray[np.float64],
+                y_field: NDArray[np.float64]) -> None:
+    """
+    Calculate the field on every body with field_at(), with the bodies
+    shared between threads. Compiled to native code with Numba.
+
+    :param cells, links, next_body: The tree from build_tree()
+    :param mass: Masses of all bodies in kilograms
+    :param x, y: Positions of all bodies in meters
+    :param theta: The opening angle, as cell width over distance
+    :param x_field, y_field: The fields divided by the gravitational
+                             constant, overwritten
+    """
+    for body in prange(mass.shape[0]):
+        (x_field[body], y_field[body]) = field_at(body, cells, links,
+                                                  next_body, mass, x, y,
+                                                  theta)
+
+
+# fill_fields() compiled without Numba's threads, with prange running as a
+# plain range, so separate trees can be walked from separate Python threads.
+# Not cached, as Numba's cache keys on the Python function and would confuse
+# this with fill_fields()
+serial_fill_fields = njit(nogil=True)(fill_fields.py_func)
+
+
+def tree_fields(mass: NDArray[np.floating[Any]],
+                x: NDArray[np.floating[Any]], y: NDArray[np.floating[Any]],
+                theta: float, parallel: bool = False
+                ) -> tuple[NDArray[np.floating[Any]],
+                           NDArray[np.floating[Any]]]:
+    """
+    Calculate the gravitational field on every body with the Barnes-Hut
+    approximation, in O(N log N) rather than O(N^2). The tree is built and
+    summed in double precision whatever the precision of the arrays.
+
+    :param mass: Masses in kilograms
+    :param x, y: Positions in meters
+    :param theta: The opening angle; 0 opens every cell and is exact
+    :param parallel: Whether to share the bodies between Numba's threads.
+                     Not every Numba threading layer survives being entered
+                     from several Python threads at once, so leave it False
+                     when walking separate trees from separate threads
+    :return: The x and y fields divided by the gravitational constant
+    """
+    (mass64, x64, y64) = (np.asarray(array, dtype=np.float64)
+                          for array in (mass, x, y))
+    (cells, links, next_body) = build_tree(mass64, x64, y64)
+
+    x_field = np.empty_like(x64)
+    y_field = np.empty_like(y64)
+    (fill_fields if parallel else serial_fill_fields)(
+        cells, links, next_body, mass64, x64, y64, theta, x_field, y_field)
+
+    return x_field.astype(x.dtype), y_field.astype(y.dtype)
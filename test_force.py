@@ -0,0 +1,271 @@
+import os
+import subprocess
+import sys
+import unittest
+from typing import Any
+
+import numpy as np
+from numpy.typing import NDArray
+
+from force import GRAVITATIONAL_CONSTANT, MassiveObject, apply_gravity, \
+    gravitational_accelerations, simulate, tree_simulate
+from quadtree import tree_fields
+
+
+def random_bodies(n: int, seed: int = 0
+                  ) -> tuple[NDArray[np.floating[Any]],
+                             NDArray[np.floating[Any]],
+                             NDArray[np.floating[Any]]]:
+    """
+    Scatter bodies of planetary mass over a few astronomical units.
+
+    :param n: The number of bodies
+    :param seed: Seed for the random number generator
+    :return: Masses in kilograms and x and y positions in meters
+    """
+    rng = np.random.default_rng(seed)
+    return (rng.uniform(1e20, 1e24, n),
+            rng.normal(0.0, 1e11, n), rng.normal(0.0, 1e11, n))
+
+
+class TestMassiveObject(unittest.TestCase):
+    def test_apply_gravity_matches_arrays(self) -> None:
+        sun = MassiveObject('Sun', mass=1.989e30,
+                            x=1e9, y=-2e9, vx=0.0, vy=0.0)
+        earth = MassiveObject('Earth', mass=5.972e24,
+                              x=147.61e9, y=3e10, vx=0.0, vy=0.0)
+        time_step = 8640.0
+        (ax, ay) = gravitational_accelerations(
+            np.array([sun.mass, earth.mass]), np.array([sun.x, earth.x]),
+            np.array([sun.y, earth.y]))
+
+        apply_gravity(sun, earth, time_step)
+
+        np.testing.assert_allclose([sun.vx, earth.vx], time_step * ax,
+                                   rtol=1e-12)
+        np.testing.assert_allclose([sun.vy, earth.vy], time_step * ay,
+                                   rtol=1e-12)
+
+    def test_apply_force_uses_inverse_mass(self) -> None:
+        earth = MassiveObject('Earth', mass=5.972e24,
+                              x=0.0, y=0.0, vx=1.0, vy=-1.0)
+
+        earth.apply_force(3.5e22, -7e22, 10.0)
+
+        self.assertAlmostEqual(earth.vx, 1.0 + 10.0 * 3.5e22 / 5.972e24)
+        self.assertAlmostEqual(earth.vy, -1.0 - 10.0 * 7e22 / 5.972e24)
+
+
+class TestTreeFields(unittest.TestCase):
+    def test_zero_theta_is_exact(self) -> None:
+        (mass, x, y) = random_bodies(300)
+        (x_field, y_field) = tree_fields(mass, x, y, 0.0)
+        (ax, ay) = gravitational_accelerations(mass, x, y)
+
+        np.testing.assert_allclose(GRAVITATIONAL_CONSTANT * x_field, ax,
+                                   rtol=1e-9, atol=1e-9 * np.abs(ax).max())
+        np.testing.assert_allclose(GRAVITATIONAL_CONSTANT * y_field, ay,
+                                   rtol=1e-9, atol=1e-9 * np.abs(ay).max())
+
+    def test_no_self_attraction_at_wide_theta(self) -> None:
+        # The root cell contains both bodies, so accepting it would pull
+        # each body towards the pair's centre of mass, partly by itself
+        mass = np.array([1e30, 1e24])
+        x = np.array([0.0, 1.5e11])
+        y = np.array([0.0, 0.0])
+        (x_field, y_field) = tree_fields(mass, x, y, 10.0)
+        (ax, ay) = gravitational_accelerations(mass, x, y)
+
+        np.testing.assert_allclose(GRAVITATIONAL_CONSTANT * x_field, ax)
+        np.testing.assert_allclose(GRAVITATIONAL_CONSTANT * y_field, ay)
+
+    def test_half_theta_is_close(self) -> None:
+        (mass, x, y) = random_bodies(1000)
+        (x_field, y_field) = tree_fields(mass, x, y, 0.5)
+        (ax, ay) = gravitational_accelerations(mass, x, y)
+
+        error = np.hypot(GRAVITATIONAL_CONSTANT * x_field - ax,
+                         GRAVITATIONAL_CONSTANT * y_field - ay)
+        self.assertLess(np.median(error / np.hypot(ax, ay)), 1e-2)
+
+
+def orbiting_bodies(n: int, dtype: type[np.floating[Any]] = np.float64,
+                    seed: int = 0) -> tuple[NDArray[np.floating[Any]], ...]:
+    """
+    Put a star at the origin and planets on roughly circular orbits around
+    it, with velocities half a time step behind as simulate() expects.
+
+    :param n: The number of bodies, star included
+    :param dtype: The precision of the state
+    :param seed: Seed for the random number generator
+    :return: Masses in kilograms, x and y positions in meters and x and y
+             velocities in meters per second
+    """
+    (mass, x, y) = random_bodies(n, seed)
+    mass[0] = 1.989e30
+    x[0] = y[0] = 0.0
+    speed = np.sqrt(GRAVITATIONAL_CONSTANT * mass[0] / np.hypot(x, y)[1:])
+    radius = np.hypot(x[1:], y[1:])
+    vx = np.zeros(n)
+    vy = np.zeros(n)
+    vx[1:] = -speed * y[1:] / radius
+    vy[1:] = speed * x[1:] / radius
+    return tuple(np.array(array, dtype=dtype)
+                 for array in (mass, x, y, vx, vy))
+
+
+def sun_and_earth(dtype: type[np.floating[Any]], time_step: float
+                  ) -> tuple[NDArray[np.floating[Any]], ...]:
+    """
+    Set up the Sun and Earth as main() does, with velocities half a time
+    step behind.
+
+    :param dtype: The precision of the state
+    :param time_step: The time step in seconds
+    :return: Masses in kilograms, x and y positions in meters and x and y
+             velocities in meters per second
+    """
+    (mass, x, y, vx, vy) = np.array([[1.989e30, 5.972e24],
+                                     [0.0, 147.61e9],
+                                     [0.0, 0.0],
+                                     [0.0, 0.0],
+                                     [0.0, -29_784.8]], dtype=dtype)
+    (ax, ay) = gravitational_accelerations(mass, x, y)
+    vx -= 0.5 * time_step * ax
+    vy -= 0.5 * time_step * ay
+    return mass, x, y, vx, vy
+
+
+class TestRunners(unittest.TestCase):
+    seconds_in_one_step = 24 * 60 * 60 / 10
+    total_steps = 40
+    sample_every = 10
+
+    def test_single_precision_year_matches_double(self) -> None:
+        # Without the Kahan compensation in kick_and_drift() Earth ends the
+        # year about 2e-5 away, relative to its distance from the Sun
+        days_in_one_year = 365
+        final = {}
+        for dtype in (np.float32, np.float64):
+            (mass, x, y, vx, vy) = sun_and_earth(dtype,
+                                                 self.seconds_in_one_step)
+            simulate(mass, x, y, vx, vy, self.seconds_in_one_step,
+                     days_in_one_year * 10, 10, 1,
+                     np.empty((days_in_one_year, 2)))
+            final[dtype] = np.array([x[1], y[1]], dtype=np.float64)
+
+        error = np.hypot(*(final[np.float32] - final[np.float64]))
+        self.assertLess(error / np.hypot(*final[np.float64]), 5e-6)
+
+    def test_two_body_simulate_matches_tree(self) -> None:
+        # simulate() takes two_body_step() for two bodies, and the tree at
+        # theta = 0 sums the same pair independently
+        (mass, x, y, vx, vy) = sun_and_earth(np.float64,
+                                             self.seconds_in_one_step)
+        (tree_x, tree_y, tree_vx, tree_vy) = (
+            array.copy() for array in (x, y, vx, vy))
+        out = np.empty((self.total_steps // self.sample_every, 2))
+        tree_out = np.empty_like(out)
+
+        simulate(mass, x, y, vx, vy, self.seconds_in_one_step,
+                 self.total_steps, self.sample_every, 1, out)
+        tree_simulate(mass, tree_x, tree_y, tree_vx, tree_vy,
+                      self.seconds_in_one_step, self.total_steps,
+                      self.sample_every, 1, tree_out, 0.0)
+
+        np.testing.assert_allclose(tree_out, out, rtol=1e-12)
+        np.testing.assert_allclose(tree_vx, vx, rtol=1e-12, atol=1e-9)
+        np.testing.assert_allclose(tree_vy, vy, rtol=1e-12, atol=1e-9)
+
+    def test_zero_theta_tree_matches_simulate(self) -> None:
+        (mass, x, y, vx, vy) = orbiting_bodies(50)
+        (tree_x, tree_y, tree_vx, tree_vy) = (
+            array.copy() for array in (x, y, vx, vy))
+        out = np.empty((self.total_steps // self.sample_every, 2))
+        tree_out = np.empty_like(out)
+
+        simulate(mass, x, y, vx, vy, self.seconds_in_one_step,
+                 self.total_steps, self.sample_every, 7, out)
+        tree_simulate(mass, tree_x, tree_y, tree_vx, tree_vy,
+                      self.seconds_in_one_step, self.total_steps,
+                      self.sample_every, 7, tree_out, 0.0)
+
+        np.testing.assert_allclose(tree_x, x, rtol=1e-9)
+        np.testing.assert_allclose(tree_y, y, rtol=1e-9)
+        np.testing.assert_allclose(tree_out, out, rtol=1e-9)
+
+    def test_cuda_simulate_matches_simulate(self) -> None:
+        # The simulator is only enabled if set before Numba is imported, so
+        # the comparison runs in a fresh interpreter
+        script = f"""
+import numpy as np
+from force import cuda_simulate, simulate
+from test_force import orbiting_bodies
+
+(mass, x, y, vx, vy) = orbiting_bodies(300, np.float32)
+(cuda_x, cuda_y, cuda_vx, cuda_vy) = (
+    array.copy() for array in (x, y, vx, vy))
+out = np.empty(({self.total_steps // self.sample_every}, 2))
+cuda_out = np.empty_like(out)
+
+simulate(mass, x, y, vx, vy, np.float32({self.seconds_in_one_step}),
+         {self.total_steps}, {self.sample_every}, 7, out)
+cuda_simulate(mass, cuda_x, cuda_y, cuda_vx, cuda_vy,
+              {self.seconds_in_one_step}, {self.total_steps},
+              {self.sample_every}, 7, cuda_out)
+
+np.testing.assert_allclose(cuda_x, x, atol=1e-5 * abs(x).max())
+np.testing.assert_allclose(cuda_y, y, atol=1e-5 * abs(y).max())
+np.testing.assert_allclose(cuda_out, out, atol=1e-5 * abs(out).max())
+"""
+        subprocess.run([sys.executable, '-c', script], check=True,
+                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                       env=os.environ | {'NUMBA_ENABLE_CUDASIM': '1'})
+
+
+class TestThreads(unittest.TestCase):
+    def test_simulations_from_separate_threads(self) -> None:
+        # The threading layer is chosen and started once per process, and the
+        # failures only show on a cold start, so this runs in a fresh
+        # interpreter. Workqueue aborts on any concurrent use, and TBB hangs
+        # at exit after it
+        script = """
+import threading
+import numpy as np
+from force import simulate
+from quadtree import tree_fields
+from test_force import orbiting_bodies
+
+(mass, x, y, vx, vy) = orbiting_bodies(400)
+expected_x = x.copy()
+simulate(mass, expected_x, y.copy(), vx.copy(), vy.copy(), 8640.0, 50, 10,
+         7, np.empty((5, 2)))
+results = [None] * 4
+
+def run(thread):
+    (thread_x, thread_y) = (x.copy(), y.copy())
+    simulate(mass, thread_x, thread_y, vx.copy(), vy.copy(), 8640.0, 50, 10,
+             7, np.empty((5, 2)))
+    tree_fields(mass, thread_x, thread_y, 0.5)
+    results[thread] = thread_x
+
+threads = [threading.Thread(target=run, args=(thread,))
+           for thread in range(4)]
+for thread in threads:
+    thread.start()
+for thread in threads:
+    thread.join()
+for thread_x in results:
+    np.testing.assert_array_equal(thread_x, expected_x)
+"""
+        for layer in ('default', 'workqueue'):
+            with self.subTest(layer=layer):
+                subprocess.run([sys.executable, '-c', script], check=True,
+                               timeout=600,
+                               cwd=os.path.dirname(os.path.abspath(__file__)),
+                               env=os.environ
+                               | {'NUMBA_THREADING_LAYER': layer})
+
+
+if __name__ == '__main__':
+    unittest.main()